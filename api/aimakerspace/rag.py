@@ -1,78 +1,515 @@
+import asyncio
+import hashlib
+import os
+import time
+from functools import lru_cache
 import numpy as np
-from typing import List, Dict, Any
-from openai import OpenAI
+import tiktoken
+from typing import AsyncIterable, List, Dict, Any, Optional
+import openai
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+from aimakerspace.storage import DocumentStore, MatrixStore
+
+# Limits for a single /v1/embeddings request
+EMBEDDING_BATCH_SIZE = 96
+EMBEDDING_BATCH_TOKENS = 250_000
+# Maximum number of embedding requests in flight at once
+EMBEDDING_CONCURRENCY = 5
+# Errors worth retrying an embedding request for, with exponential backoff
+EMBEDDING_RETRY_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+# Chunk text and embedding matrix, memory-mapped from files with this prefix;
+# RAG.reset() (or deleting the files) starts over from an empty index
+INDEX_STORE_PATH = "/tmp/rag"
+EMBEDDING_DIM = 1536
+# Rows converted to float32 at a time when scoring float16 without SimSIMD
+UPCAST_BLOCK_ROWS = 4096
+
+# Semantic answer cache: a question this close to a cached one reuses its answer
+QA_CACHE_FILE = "/tmp/qa_cache.npz"
+QA_CACHE_THRESHOLD = 0.97
+# Cached answers kept per corpus; the oldest is replaced once the cache is full
+QA_CACHE_SIZE = 256
+# The answer cache file is rewritten after this many new answers or seconds, whichever comes first
+QA_CACHE_SAVE_EVERY = 16
+QA_CACHE_SAVE_INTERVAL = 60.0
+
+# Items buffered between stages of the add_pages pipeline
+PIPELINE_QUEUE_SIZE = 4
+
+# Number of chunks retrieved as context for each question
+TOP_K = 3
+
+# Tokenizer used by text-embedding-3-small, for fixed-size chunking
+CHUNK_ENCODING = "cl100k_base"
+
+try:
+    import simsimd
+except ImportError:  # optional SIMD kernels, fall back to Numba or NumPy
+    simsimd = None
+
+try:
+    from numba import njit, prange
+except ImportError:  # optional JIT kernel, fall back to NumPy
+    njit = None
+
+
+@lru_cache(maxsize=None)
+def _get_encoding() -> tiktoken.Encoding:
+    """Load the chunking tokenizer once and reuse it"""
+    return tiktoken.get_encoding(CHUNK_ENCODING)
+
+
+def _dot_scores_kernel(matrix, q):
+    """Dot product of q with every row of matrix, parallel over rows"""
+    n, dim = matrix.shape
+    scores = np.empty(n, dtype=np.float32)
+    for i in prange(n):
+        acc = np.float32(0.0)
+        for j in range(dim):
+            acc += np.float32(matrix[i, j]) * q[j]
+        scores[i] = acc
+    return scores
+
+
+if njit is not None:
+    try:
+        _dot_scores = njit(parallel=True, fastmath=True, cache=True)(_dot_scores_kernel)
+    except RuntimeError:
+        # No writable cache location (e.g. a read-only serverless bundle): compile per process
+        _dot_scores = njit(parallel=True, fastmath=True)(_dot_scores_kernel)
+else:
+    _dot_scores = None
+
+
+class _TokenChunker:
+    """Incremental fixed-token sliding window over text fed in pieces"""
+    
+    def __init__(self, chunk_size: int = 512, overlap: int = 64):
+        if overlap >= chunk_size:
+            raise ValueError("overlap must be smaller than chunk_size")
+        self.chunk_size = chunk_size
+        self.step = chunk_size - overlap
+        self.overlap = overlap
+        self.encoding = _get_encoding()
+        self._ids: List[int] = []
+        self._emitted = False
+    
+    def feed(self, text: str) -> List[str]:
+        """Add text and return every window that is now complete"""
+        # Document text is data: special-token strings like <|endoftext|> are encoded as plain text
+        self._ids.extend(self.encoding.encode_ordinary(text))
+        chunks = []
+        start = 0
+        while len(self._ids) - start >= self.chunk_size:
+            chunks.append(self._decode(self._ids[start:start + self.chunk_size]))
+            start += self.step
+        if chunks:
+            self._ids = self._ids[start:]
+            self._emitted = True
+        return chunks
+    
+    def finish(self) -> List[str]:
+        """Return the final partial window, if it holds any new tokens"""
+        ids, self._ids = self._ids, []
+        if len(ids) > self.overlap or (ids and not self._emitted):
+            return [self._decode(ids)]
+        return []
+    
+    def _decode(self, ids: List[int]) -> str:
+        """Decode a window, dropping characters cut in half at its edges"""
+        # A window edge can fall inside a multi-byte character; the partial bytes are
+        # the only invalid UTF-8 here, and the overlap keeps the whole character in the
+        # neighbouring window, so they are dropped instead of becoming U+FFFD
+        return self.encoding.decode_bytes(ids).decode("utf-8", errors="ignore")
+
+
+def _matrix_dot(matrix: np.ndarray, q: np.ndarray) -> np.ndarray:
+    """Dot product of q with every row of matrix: SimSIMD, then Numba, then NumPy"""
+    if simsimd is not None:
+        q = np.ascontiguousarray(q, dtype=matrix.dtype).reshape(1, -1)
+        return np.asarray(simsimd.cdist(q, matrix, metric='dot'), dtype=np.float32)[0]
+    q = np.ascontiguousarray(q, dtype=np.float32)
+    # Numba has no float16 type, so half-precision rows are upcast before scoring
+    if _dot_scores is not None and matrix.dtype != np.float16:
+        return _dot_scores(matrix, q)
+    if matrix.dtype == np.float32:
+        return matrix @ q
+    # Upcast a block of rows at a time to keep the float32 temporary small
+    scores = np.empty(len(matrix), dtype=np.float32)
+    for start in range(0, len(matrix), UPCAST_BLOCK_ROWS):
+        block = matrix[start:start + UPCAST_BLOCK_ROWS].astype(np.float32)
+        if _dot_scores is not None:
+            scores[start:start + UPCAST_BLOCK_ROWS] = _dot_scores(block, q)
+        else:
+            scores[start:start + UPCAST_BLOCK_ROWS] = block @ q
+    return scores
+
+
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first, in O(N + k log k)"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    top_idx = np.argpartition(scores, -k)[-k:]
+    return top_idx[np.argsort(scores[top_idx])[::-1]]
 
 
 class RAG:
     """Simple RAG implementation using OpenAI embeddings and chat completions"""
     
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
-        self.documents = []
-        self.embeddings = []
+    def __init__(self, api_key: str, quantize: bool = False,
+                 index_path: Optional[str] = INDEX_STORE_PATH,
+                 qa_cache_path: Optional[str] = QA_CACHE_FILE):
+        self.client = AsyncOpenAI(api_key=api_key)
+        # Store embeddings as per-row scaled int8 instead of float16 (2x smaller)
+        self.quantize = quantize
+        # Chunk text and its unit-norm embedding rows, reloaded from disk if present
+        self.index_path = index_path
+        self._open_index()
+        # Unit-norm question embeddings and their answers for the current corpus
+        self.qa_cache_path = qa_cache_path
+        self._qa_vectors = np.zeros((QA_CACHE_SIZE, EMBEDDING_DIM), dtype=np.float32)
+        self._qa_answers: List[str] = []
+        self._qa_next = 0
+        self._qa_unsaved = 0
+        self._qa_saved_at = time.monotonic()
+        self._load_qa_cache()
+    
+    def _index_file(self, suffix: str) -> Optional[str]:
+        """Path of one index file, or None when the index is memory only"""
+        return f"{self.index_path}_{suffix}" if self.index_path else None
+    
+    def _index_paths(self) -> List[Optional[str]]:
+        """Chunk text, embedding and (when quantizing) scale files of the index"""
+        vector_suffix = 'emb.i8' if self.quantize else 'emb.f16'
+        paths = [self._index_file('docs.txt'), self._index_file(vector_suffix)]
+        if self.quantize:
+            paths.append(self._index_file('scales.f32'))
+        return paths
+    
+    def _open_index(self):
+        """Map the stored chunks and embeddings, discarding them if they disagree"""
+        vector_dtype = np.int8 if self.quantize else np.float16
+        paths = self._index_paths()
+        
+        def load():
+            self.documents = DocumentStore(paths[0])
+            count = len(self.documents)
+            self._vectors = MatrixStore(EMBEDDING_DIM, vector_dtype, paths[1], count)
+            self._scales = MatrixStore(1, np.float32, paths[2], count) if self.quantize else None
+            return len(self._vectors) == count and (self._scales is None or len(self._scales) == count)
+        
+        if not load():
+            # Partially written index from an earlier process: start over
+            self._remove_index_files()
+            load()
+        
+        # Row of each stored chunk by content hash, so re-added chunks are skipped
+        self._chunk_rows: Dict[str, int] = {}
+        self._corpus_hash = hashlib.sha256()
+        for row, chunk in enumerate(self.documents):
+            self._chunk_rows[self._content_key(chunk)] = row
+            self._corpus_hash.update(chunk.encode())
+    
+    def _remove_index_files(self):
+        """Delete every file of the stored index"""
+        for path in self._index_paths() + [self.documents.offsets_path]:
+            if path and os.path.exists(path):
+                os.remove(path)
+    
+    def reset(self):
+        """Delete the stored index and start over with no documents"""
+        self._remove_index_files()
+        self._open_index()
+        self._load_qa_cache()
     
-    def add_document(self, text: str):
+    @staticmethod
+    def _content_key(text: str) -> str:
+        """SHA-256 of a chunk's text, used to recognise chunks seen before"""
+        return hashlib.sha256(text.encode()).hexdigest()
+    
+    async def add_document(self, text: str):
         """Add a document to the RAG system"""
         # Split text into chunks
         chunks = self._split_text(text)
+        
+        # Generate embeddings for all chunks in concurrent batched requests
+        new_embeddings = await self._get_embeddings(chunks)
+        self._add_chunks(chunks, new_embeddings)
+    
+    async def add_pages(self, pages: AsyncIterable[str]) -> int:
+        """Add a document page by page, chunking and embedding while pages are still being read
+        
+        Returns the number of chunks in the document, including any already in the index.
+        """
+        page_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        chunk_queue: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE * EMBEDDING_BATCH_SIZE)
+        # Embedded batches by position, so the chunks keep their order however batches finish
+        results: Dict[int, List[List[float]]] = {}
+        batches: List[List[str]] = []
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        
+        async def read_pages():
+            async for page in pages:
+                await page_queue.put(page)
+            await page_queue.put(None)
+        
+        async def chunk_pages():
+            chunker = _TokenChunker()
+            while (page := await page_queue.get()) is not None:
+                for chunk in chunker.feed(page + "\n"):
+                    await chunk_queue.put(chunk)
+            for chunk in chunker.finish():
+                await chunk_queue.put(chunk)
+            await chunk_queue.put(None)
+        
+        async def embed_batch(index: int, batch: List[str]):
+            results[index] = await self._get_embeddings(batch, semaphore)
+        
+        async def batch_chunks(group: asyncio.TaskGroup):
+            batch = []
+            done = False
+            while not done:
+                chunk = await chunk_queue.get()
+                done = chunk is None
+                if not done:
+                    batch.append(chunk)
+                if batch and (done or len(batch) >= EMBEDDING_BATCH_SIZE):
+                    # Each batch runs as its own task; the semaphore bounds requests in flight
+                    group.create_task(embed_batch(len(batches), batch))
+                    batches.append(batch)
+                    batch = []
+        
+        # A failure in any stage cancels the others; surface the original error
+        try:
+            async with asyncio.TaskGroup() as group:
+                group.create_task(read_pages())
+                group.create_task(chunk_pages())
+                group.create_task(batch_chunks(group))
+        except ExceptionGroup as error:
+            raise error.exceptions[0]
+        
+        chunks = [chunk for batch in batches for chunk in batch]
+        embeddings = [embedding for index in range(len(batches)) for embedding in results[index]]
+        self._add_chunks(chunks, embeddings)
+        return len(chunks)
+    
+    def _add_chunks(self, chunks: List[str], new_embeddings: List[List[float]]):
+        """Append embedded chunks to the index and refresh the caches"""
+        # Chunks already in the index (e.g. from a re-uploaded PDF) are not stored twice
+        new_rows: Dict[str, int] = {}
+        for i, chunk in enumerate(chunks):
+            key = self._content_key(chunk)
+            if key not in self._chunk_rows and key not in new_rows:
+                new_rows[key] = i
+        if len(new_rows) < len(chunks):
+            chunks = [chunks[i] for i in new_rows.values()]
+            new_embeddings = [new_embeddings[i] for i in new_rows.values()]
+        if not chunks:
+            return
+        
+        # OpenAI embeddings are already unit-norm, so no normalization is needed
+        rows = np.ascontiguousarray(new_embeddings, dtype=np.float32)
+        if __debug__:
+            norms = np.sqrt(np.einsum('ij,ij->i', rows, rows))
+            assert np.allclose(norms, 1.0, atol=1e-3), "expected unit-norm embeddings"
+        if self.quantize:
+            rows_i8, scales = self._quantize(rows)
+            self._vectors.append(rows_i8)
+            self._scales.append(scales)
+        else:
+            self._vectors.append(rows)
+        
+        # Vectors are written first; the document offsets commit the new rows
+        first_row = len(self.documents)
         self.documents.extend(chunks)
+        for row, key in enumerate(new_rows, first_row):
+            self._chunk_rows[key] = row
         
-        # Generate embeddings for chunks
+        # Cached answers were grounded in the previous corpus, so start over
         for chunk in chunks:
-            embedding = self._get_embedding(chunk)
-            self.embeddings.append(embedding)
+            self._corpus_hash.update(chunk.encode())
+        self._load_qa_cache()
     
-    def _split_text(self, text: str, chunk_size: int = 1000) -> List[str]:
-        """Split text into chunks"""
-        words = text.split()
-        chunks = []
-        for i in range(0, len(words), chunk_size):
-            chunk = ' '.join(words[i:i + chunk_size])
-            chunks.append(chunk)
-        return chunks
+    def _load_qa_cache(self):
+        """Load cached answers from file if they belong to the current corpus"""
+        self._qa_answers = []
+        self._qa_next = 0
+        self._qa_unsaved = 0
+        try:
+            if self.qa_cache_path and os.path.exists(self.qa_cache_path):
+                with np.load(self.qa_cache_path) as data:
+                    if str(data['corpus']) == self._corpus_hash.hexdigest():
+                        answers = data['answers'].tolist()[-QA_CACHE_SIZE:]
+                        vectors = data['vectors'][-QA_CACHE_SIZE:]
+                        self._qa_vectors[:len(answers)] = vectors
+                        self._qa_answers = answers
+        except Exception:
+            pass
     
-    def _get_embedding(self, text: str) -> List[float]:
-        """Get embedding for text using OpenAI"""
+    def _add_qa_answer(self, q: np.ndarray, answer: str):
+        """Cache an answer, replacing the oldest one when the cache is full"""
+        if len(self._qa_answers) < QA_CACHE_SIZE:
+            self._qa_vectors[len(self._qa_answers)] = q
+            self._qa_answers.append(answer)
+        else:
+            self._qa_vectors[self._qa_next] = q
+            self._qa_answers[self._qa_next] = answer
+            self._qa_next = (self._qa_next + 1) % QA_CACHE_SIZE
+        # Rewriting the file costs milliseconds, so new answers are persisted in batches
+        self._qa_unsaved += 1
+        if (self._qa_unsaved >= QA_CACHE_SAVE_EVERY
+                or time.monotonic() - self._qa_saved_at >= QA_CACHE_SAVE_INTERVAL):
+            self._save_qa_cache()
+    
+    def _save_qa_cache(self):
+        """Save cached answers to file, oldest first"""
+        if not self.qa_cache_path or not self._qa_answers:
+            return
+        order = np.roll(np.arange(len(self._qa_answers)), -self._qa_next)
         try:
-            response = self.client.embeddings.create(
-                model="text-embedding-3-small",
-                input=text
-            )
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"Error getting embedding: {e}")
-            return [0.0] * 1536  # Default embedding size
+            tmp_path = f"{self.qa_cache_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.savez(
+                    f,
+                    corpus=np.array(self._corpus_hash.hexdigest()),
+                    vectors=self._qa_vectors[order].astype(np.float16),
+                    answers=np.array([self._qa_answers[i] for i in order], dtype=str),
+                )
+            os.replace(tmp_path, self.qa_cache_path)
+            self._qa_unsaved = 0
+            self._qa_saved_at = time.monotonic()
+        except Exception:
+            pass
+    
+    @staticmethod
+    def _quantize(rows: np.ndarray):
+        """Symmetric int8 quantization with one scale per row"""
+        rows = np.atleast_2d(rows)
+        scales = np.abs(rows).max(axis=1).astype(np.float32) / 127.0
+        scales[scales == 0] = 1.0
+        rows_i8 = np.round(rows / scales[:, None]).astype(np.int8)
+        return np.ascontiguousarray(rows_i8), scales
+    
+    def _stored_embedding(self, row: int) -> np.ndarray:
+        """Embedding of a stored chunk as float32, undoing int8 quantization"""
+        vector = self._vectors.array[row].astype(np.float32)
+        if self.quantize:
+            vector *= self._scales.array[row, 0]
+        return vector
     
-    def _cosine_similarity(self, a: List[float], b: List[float]) -> float:
-        """Calculate cosine similarity between two vectors"""
-        a = np.array(a)
-        b = np.array(b)
-        return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+    def _similarities(self, q: np.ndarray) -> np.ndarray:
+        """Cosine similarity of a unit-norm query against every stored chunk"""
+        # Rows and query are unit-norm, so cosine similarity is a plain dot product
+        if self.quantize:
+            q_i8, q_scale = self._quantize(q)
+            dots = _matrix_dot(self._vectors.array, q_i8[0])
+            # Undoing the row and query scales recovers the float dot product
+            return dots * self._scales.array[:, 0] * q_scale[0]
+        return _matrix_dot(self._vectors.array, q)
     
-    def query(self, question: str) -> str:
+    def _split_text(self, text: str, chunk_size: int = 512, overlap: int = 64) -> List[str]:
+        """Split text into fixed-token chunks using a sliding window"""
+        chunker = _TokenChunker(chunk_size, overlap)
+        return chunker.feed(text) + chunker.finish()
+    
+    @staticmethod
+    def _batch_texts(texts: List[str]) -> List[List[str]]:
+        """Group texts into batches that fit a single embeddings request"""
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = len(text) // 4  # rough token estimate
+            if batch and (len(batch) >= EMBEDDING_BATCH_SIZE
+                          or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+    
+    @retry(
+        retry=retry_if_exception_type(EMBEDDING_RETRY_ERRORS),
+        stop=stop_after_attempt(5),
+        wait=wait_exponential_jitter(initial=1, max=30),
+        reraise=True,
+    )
+    async def _create_embeddings(self, batch: List[str]):
+        """Request embeddings for one batch, retrying transient API errors"""
+        # tenacity owns retries here; the SDK's own retries stay on for chat completions
+        return await self.client.with_options(max_retries=0).embeddings.create(
+            model="text-embedding-3-small",
+            input=batch
+        )
+    
+    async def _get_embeddings(self, texts: List[str],
+                              semaphore: Optional[asyncio.Semaphore] = None) -> List[List[float]]:
+        """Get embeddings for a list of texts, only requesting chunks not yet indexed from OpenAI
+        
+        Pass a shared semaphore to bound requests in flight across several calls.
+        """
+        # The index doubles as the embedding cache: a chunk seen before reuses its stored row
+        rows = [self._chunk_rows.get(self._content_key(text)) for text in texts]
+        embeddings = [None if row is None else self._stored_embedding(row) for row in rows]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        
+        # Pair each batch with the positions its results belong to
+        batches = []
+        position = 0
+        for batch in self._batch_texts([texts[i] for i in missing]):
+            batches.append((batch, missing[position:position + len(batch)]))
+            position += len(batch)
+        
+        semaphore = semaphore or asyncio.Semaphore(EMBEDDING_CONCURRENCY)
+        
+        async def embed_batch(batch: List[str], indices: List[int]):
+            async with semaphore:
+                response = await self._create_embeddings(batch)
+            for i, item in zip(indices, response.data):
+                embeddings[i] = item.embedding
+        
+        await asyncio.gather(*[embed_batch(batch, indices) for batch, indices in batches])
+        return embeddings
+    
+    async def query(self, question: str) -> str:
         """Query the RAG system"""
         if not self.documents:
             return "No documents have been added to the RAG system yet."
         
         # Get embedding for the question
-        question_embedding = self._get_embedding(question)
+        # Questions bypass the chunk embedding cache so they never end up persisted with it
+        response = await self._create_embeddings([question])
+        q = np.asarray(response.data[0].embedding, dtype=np.float32)
+        
+        # Reuse the answer to a near-duplicate question if we have one
+        if self._qa_answers:
+            qa_sims = self._qa_vectors[:len(self._qa_answers)] @ q
+            best = int(np.argmax(qa_sims))
+            if qa_sims[best] > QA_CACHE_THRESHOLD:
+                return self._qa_answers[best]
         
-        # Find most similar documents
-        similarities = []
-        for i, doc_embedding in enumerate(self.embeddings):
-            similarity = self._cosine_similarity(question_embedding, doc_embedding)
-            similarities.append((i, similarity))
+        # Documents added while the answer is generated make it stale for the new corpus
+        corpus = self._corpus_hash.hexdigest()
         
-        # Sort by similarity and get top 3
-        similarities.sort(key=lambda x: x[1], reverse=True)
-        top_docs = [self.documents[i] for i, _ in similarities[:3]]
+        # Cosine similarity against every chunk in a single batched kernel
+        sims = self._similarities(q)
+        
+        # Select the best chunks without sorting the full similarity array
+        top_docs = [self.documents[i] for i in _top_k_indices(sims, TOP_K)]
         
         # Create context from top documents
         context = "\n\n".join(top_docs)
         
         # Generate response using OpenAI
         try:
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model="gpt-4o-mini",
                 messages=[
                     {
@@ -83,7 +520,11 @@ class RAG:
                 ],
                 max_tokens=500
             )
-            return response.choices[0].message.content
+            answer = response.choices[0].message.content
         except Exception as e:
             return f"Error generating response: {str(e)}"
+        
+        if answer is not None and self._corpus_hash.hexdigest() == corpus:
+            self._add_qa_answer(q, answer)
+        return answer
 
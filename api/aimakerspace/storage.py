@@ -0,0 +1,126 @@
+import os
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+
+class MatrixStore:
+    """Append-only ``(N, dim)`` matrix kept in one contiguous buffer.
+
+    With a ``path`` the buffer is a ``np.memmap`` over that file, so a fresh
+    process can map previously written rows without copying them. Without a
+    ``path`` it is a plain in-memory array. Capacity grows by doubling.
+    """
+
+    def __init__(self, dim: int, dtype, path: Optional[str] = None, count: int = 0):
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        self.count = 0
+        self._buffer = np.empty((0, dim), dtype=self.dtype)
+
+        if path and count and os.path.exists(path):
+            row_bytes = dim * self.dtype.itemsize
+            capacity = os.path.getsize(path) // row_bytes
+            if capacity >= count:
+                self._buffer = self._map(capacity)
+                self.count = count
+
+    @property
+    def array(self) -> np.ndarray:
+        """View of the rows written so far."""
+
+        return self._buffer[: self.count]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, rows: np.ndarray) -> None:
+        """Copy ``rows`` onto the end of the matrix, growing it if needed."""
+
+        rows = np.asarray(rows, dtype=self.dtype).reshape(-1, self.dim)
+        needed = self.count + len(rows)
+        if needed > len(self._buffer):
+            self._grow(max(needed, 2 * len(self._buffer), 64))
+        self._buffer[self.count:needed] = rows
+        self.count = needed
+        if isinstance(self._buffer, np.memmap):
+            self._buffer.flush()
+
+    def _map(self, capacity: int) -> np.memmap:
+        return np.memmap(self.path, dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+
+    def _grow(self, capacity: int) -> None:
+        if not self.path:
+            grown = np.empty((capacity, self.dim), dtype=self.dtype)
+            grown[: self.count] = self._buffer[: self.count]
+            self._buffer = grown
+            return
+
+        # Extend the backing file in place and remap; existing rows stay put
+        if isinstance(self._buffer, np.memmap):
+            self._buffer.flush()
+        self._buffer = None
+        mode = "r+b" if self.count and os.path.exists(self.path) else "wb"
+        with open(self.path, mode) as f:
+            f.truncate(capacity * self.dim * self.dtype.itemsize)
+        self._buffer = self._map(capacity)
+
+
+class DocumentStore:
+    """Append-only list of strings stored as one UTF-8 blob plus row offsets.
+
+    ``path`` holds the concatenated text and ``path + ".offsets.npy"`` the
+    ``N + 1`` byte offsets; the offsets file is written last, so it defines
+    how many documents were committed.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.offsets_path = f"{path}.offsets.npy" if path else None
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._blob = bytearray()
+
+        if path and os.path.exists(path) and os.path.exists(self.offsets_path):
+            offsets = np.load(self.offsets_path)
+            if len(offsets) and os.path.getsize(path) >= offsets[-1]:
+                self._offsets = offsets
+                with open(path, "rb") as f:
+                    self._blob = bytearray(f.read(int(offsets[-1])))
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("document index out of range")
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return self._blob[start:end].decode("utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def extend(self, texts: Iterable[str]) -> None:
+        """Append ``texts`` to the blob and record their offsets."""
+
+        encoded: List[bytes] = [text.encode("utf-8") for text in texts]
+        if not encoded:
+            return
+        lengths = np.fromiter((len(data) for data in encoded), dtype=np.int64, count=len(encoded))
+        start = len(self._blob)
+        data = b"".join(encoded)
+        self._blob += data
+        self._offsets = np.concatenate([self._offsets, self._offsets[-1] + np.cumsum(lengths)])
+
+        if self.path:
+            with open(self.path, "r+b" if os.path.exists(self.path) else "wb") as f:
+                f.seek(start)
+                f.write(data)
+                f.truncate()
+            tmp_path = f"{self.offsets_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, self._offsets)
+            os.replace(tmp_path, self.offsets_path)
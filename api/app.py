@@ -4,13 +4,18 @@ from fastapi.middleware.cors import CORSMiddleware
 # Import Pydantic for data validation and settings management
 from pydantic import BaseModel
 # Import OpenAI client for interacting with OpenAI's API
-from openai import OpenAI
+from openai import AsyncOpenAI
 import os
 import time
 import json
+import threading
+import orjson
+from collections import OrderedDict, defaultdict, deque
+from functools import partial
 from typing import Optional
 from fastapi.responses import StreamingResponse
-import PyPDF2
+import pypdf
+import asyncio
 import io
 from aimakerspace import RAG
 
@@ -18,50 +23,107 @@ from aimakerspace import RAG
 app = FastAPI(title="OpenAI Chat API")
 
 # File-based storage for user conversations (persists across serverless function calls)
-CONVERSATIONS_FILE = "/tmp/conversations.json"
+CONVERSATIONS_FILE = "/tmp/conversations.jsonl"
 RAG_INDEX_FILE = "/tmp/rag_index.json"
 
+# Messages kept per user (the last 10 are sent as context), and the log size that triggers compaction
+HISTORY_LENGTH = 20
+CONVERSATIONS_MAX_BYTES = 5 * 1024 * 1024
+
+# OpenAI clients kept open, most recently used last
+CLIENT_CACHE_SIZE = 32
+
 # Global RAG instance
 rag_system = None
 
+# Size of the conversation log right after the last compaction
+compacted_log_size = 0
+
+# Shared OpenAI client per API key
+openai_clients: "OrderedDict[str, AsyncOpenAI]" = OrderedDict()
+
+async def get_client(api_key: str) -> AsyncOpenAI:
+    """Return a shared OpenAI client per API key so its connection pool is reused"""
+    client = openai_clients.get(api_key)
+    if client is not None:
+        openai_clients.move_to_end(api_key)
+        return client
+    client = openai_clients[api_key] = AsyncOpenAI(api_key=api_key)
+    if len(openai_clients) > CLIENT_CACHE_SIZE:
+        # Close the least recently used client so its connection pool is released
+        _, evicted = openai_clients.popitem(last=False)
+        await evicted.close()
+    return client
+
 def load_conversations():
-    """Load conversations from file"""
+    """Load the last HISTORY_LENGTH messages per user from the append-only message log"""
+    conversations = defaultdict(partial(deque, maxlen=HISTORY_LENGTH))
     try:
         if os.path.exists(CONVERSATIONS_FILE):
-            with open(CONVERSATIONS_FILE, 'r') as f:
-                return json.load(f)
+            with open(CONVERSATIONS_FILE, 'rb') as f:
+                for line in f:
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue  # skip a partially written line
+                    user_id = record.pop("uid")
+                    conversations[user_id].append(record)
     except Exception:
         pass
-    return {}
+    return conversations
 
-def save_conversations(conversations):
-    """Save conversations to file"""
-    try:
-        with open(CONVERSATIONS_FILE, 'w') as f:
-            json.dump(conversations, f)
-    except Exception:
-        pass
+def append_message(user_id, message):
+    """Add a message to the in-memory history and append it to the conversation log"""
+    with conversations_lock:
+        user_conversations[user_id].append(message)
+        try:
+            with open(CONVERSATIONS_FILE, 'ab') as f:
+                f.write(orjson.dumps({"uid": user_id, **message}) + b"\n")
+                log_size = f.tell()
+            # Compact only once the log has doubled since the last compaction, so a large
+            # retained history does not trigger a full rewrite on every message
+            if log_size > max(CONVERSATIONS_MAX_BYTES, 2 * compacted_log_size):
+                compact_conversations()
+        except Exception:
+            pass
 
-def extract_text_from_pdf(pdf_file: UploadFile) -> str:
-    """Extract text content from uploaded PDF file"""
+def compact_conversations():
+    """Rewrite the conversation log with only the messages still kept in memory"""
+    global compacted_log_size
+    tmp_file = CONVERSATIONS_FILE + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        for user_id, history in user_conversations.items():
+            for message in history:
+                f.write(orjson.dumps({"uid": user_id, **message}) + b"\n")
+        compacted_log_size = f.tell()
+    os.replace(tmp_file, CONVERSATIONS_FILE)
+
+def open_pdf(pdf_file: UploadFile) -> pypdf.PdfReader:
+    """Open an uploaded PDF file for page-by-page text extraction"""
     try:
         # Read the PDF file content
         pdf_content = pdf_file.file.read()
         pdf_file.file.seek(0)  # Reset file pointer
         
         # Create a PDF reader object
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
-        
-        # Extract text from all pages
-        text = ""
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            text += page.extract_text() + "\n"
-        
-        return text.strip()
+        return pypdf.PdfReader(io.BytesIO(pdf_content))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error extracting text from PDF: {str(e)}")
+
+def extract_page_text(page: pypdf.PageObject) -> str:
+    """Extract text content from a single PDF page"""
+    try:
+        return page.extract_text() or ""
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Error extracting text from PDF: {str(e)}")
 
+async def iter_pdf_pages(pdf_reader: pypdf.PdfReader):
+    """Yield the text of each non-empty page, extracting in a worker thread so the event loop stays free"""
+    for page in pdf_reader.pages:
+        text = await asyncio.to_thread(extract_page_text, page)
+        if text.strip():
+            yield text
+
 def initialize_rag_system(api_key: str):
     """Initialize the RAG system with OpenAI API key"""
     global rag_system
@@ -90,8 +152,9 @@ def save_rag_index(index_data):
     except Exception:
         pass
 
-# Load existing conversations
+# Load existing conversations once; the in-memory copy is authoritative for this process
 user_conversations = load_conversations()
+conversations_lock = threading.Lock()
 
 # Configure CORS (Cross-Origin Resource Sharing) middleware
 # This allows the API to be accessed from different domains/origins
@@ -122,58 +185,46 @@ class RAGChatRequest(BaseModel):
 @app.post("/api/chat")
 async def chat(request: ChatRequest):
     try:
-        # Initialize OpenAI client with the provided API key
-        client = OpenAI(api_key=request.api_key)
-        
-        # Load fresh conversations (in case another function instance updated them)
-        user_conversations = load_conversations()
-        
-        # Get or create conversation history for this user
-        if request.user_id not in user_conversations:
-            user_conversations[request.user_id] = []
+        # Get the OpenAI client for the provided API key
+        client = await get_client(request.api_key)
         
-        # Add the new user message to conversation history
-        user_conversations[request.user_id].append({
+        # Add the new user message to conversation history and save it immediately
+        append_message(request.user_id, {
             "role": "user", 
             "content": request.user_message,
             "timestamp": str(time.time())
         })
         
-        # Save conversations immediately
-        save_conversations(user_conversations)
-        
         # Prepare messages for OpenAI (system + conversation history)
         messages = [{"role": "system", "content": "You are a helpful AI assistant. Always provide clear, accurate, and well-structured responses. When explaining concepts, use simple language and relatable examples. When summarizing, capture all key points concisely. When writing creatively, be imaginative and engaging. When solving problems, show your reasoning step-by-step. When rewriting text, maintain professional tone and correct all errors."}]
-        messages.extend(user_conversations[request.user_id][-10:])  # Keep last 10 messages
+        with conversations_lock:
+            messages.extend(list(user_conversations[request.user_id])[-10:])  # Keep last 10 messages
         
         # Create an async generator function for streaming responses
         async def generate():
             # Create a streaming chat completion request
-            stream = client.chat.completions.create(
+            stream = await client.chat.completions.create(
                 model=request.model,
                 messages=messages,
                 stream=True  # Enable streaming response
             )
             
-            # Collect the full response for storage
-            full_response = ""
+            # Collect the response parts for storage
+            response_parts = []
             
             # Yield each chunk of the response as it becomes available
-            for chunk in stream:
+            async for chunk in stream:
                 if chunk.choices[0].delta.content is not None:
                     content = chunk.choices[0].delta.content
-                    full_response += content
+                    response_parts.append(content)
                     yield content
             
-            # Store the AI response in conversation history
-            user_conversations[request.user_id].append({
+            # Store and save the AI response in conversation history
+            append_message(request.user_id, {
                 "role": "assistant", 
-                "content": full_response,
+                "content": "".join(response_parts),
                 "timestamp": str(time.time())
             })
-            
-            # Save conversations after AI response
-            save_conversations(user_conversations)
 
         # Return a streaming response to the client
         return StreamingResponse(generate(), media_type="text/plain")
@@ -190,16 +241,15 @@ async def health_check():
 # Get user conversation history
 @app.get("/api/conversations/{user_id}")
 async def get_conversations(user_id: str):
-    # Load fresh conversations
-    conversations = load_conversations()
-    
-    if user_id not in conversations:
-        return {"conversations": [], "message": "No conversations found for this user"}
+    with conversations_lock:
+        if user_id not in user_conversations:
+            return {"conversations": [], "message": "No conversations found for this user"}
+        conversations = list(user_conversations[user_id])
     
     return {
         "user_id": user_id,
-        "conversations": conversations[user_id],
-        "total_messages": len(conversations[user_id])
+        "conversations": conversations,
+        "total_messages": len(conversations)
     }
 
 # PDF Upload endpoint
@@ -215,31 +265,37 @@ async def upload_pdf(
         if not file.filename.lower().endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are allowed")
         
-        # Extract text from PDF
-        pdf_text = extract_text_from_pdf(file)
-        
-        if not pdf_text.strip():
-            raise HTTPException(status_code=400, detail="No text content found in PDF")
+        # Open the PDF in a worker thread so the event loop stays free
+        pdf_reader = await asyncio.to_thread(open_pdf, file)
         
         # Initialize RAG system
         rag = initialize_rag_system(api_key)
         
-        # Index the PDF content
-        rag.add_document(pdf_text)
+        # Index the PDF content, embedding early pages while later ones are still parsed
+        text_length = 0
+        
+        async def pages():
+            nonlocal text_length
+            async for text in iter_pdf_pages(pdf_reader):
+                text_length += len(text)
+                yield text
+        
+        if not await rag.add_pages(pages()):
+            raise HTTPException(status_code=400, detail="No text content found in PDF")
         
         # Save the index
         index_data = load_rag_index()
         index_data[user_id] = {
             "filename": file.filename,
             "upload_time": str(time.time()),
-            "text_length": len(pdf_text)
+            "text_length": text_length
         }
         save_rag_index(index_data)
         
         return {
             "message": "PDF uploaded and indexed successfully",
             "filename": file.filename,
-            "text_length": len(pdf_text),
+            "text_length": text_length,
             "user_id": user_id
         }
         
@@ -254,39 +310,26 @@ async def rag_chat(request: RAGChatRequest):
         # Initialize RAG system
         rag = initialize_rag_system(request.api_key)
         
-        # Load fresh conversations
-        user_conversations = load_conversations()
-        
-        # Get or create conversation history for this user
-        if request.user_id not in user_conversations:
-            user_conversations[request.user_id] = []
-        
-        # Add the new user message to conversation history
-        user_conversations[request.user_id].append({
+        # Add the new user message to conversation history and save it immediately
+        append_message(request.user_id, {
             "role": "user", 
             "content": request.user_message,
             "timestamp": str(time.time())
         })
         
-        # Save conversations immediately
-        save_conversations(user_conversations)
-        
         # Create an async generator function for streaming responses
         async def generate():
             try:
                 # Use RAG to get context-aware response
-                response = rag.query(request.user_message)
+                response = await rag.query(request.user_message)
                 
-                # Store the AI response in conversation history
-                user_conversations[request.user_id].append({
+                # Store and save the AI response in conversation history
+                append_message(request.user_id, {
                     "role": "assistant", 
                     "content": response,
                     "timestamp": str(time.time())
                 })
                 
-                # Save conversations after AI response
-                save_conversations(user_conversations)
-                
                 # Yield the response
                 yield response
                 